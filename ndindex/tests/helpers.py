@@ -1,19 +1,19 @@
-import sys
-from itertools import chain
-from functools import reduce
+from itertools import chain, product, zip_longest
+from functools import reduce, lru_cache
 from operator import mul
 
-from numpy import intp, bool_, array, broadcast_shapes
+from numpy import intp, bool_, array, arange, dtype, ndarray, frombuffer
 import numpy.testing
 
 from pytest import fail
 
 from hypothesis import assume, note
 from hypothesis.strategies import (integers, none, one_of, lists, just,
-                                   builds, shared, composite, sampled_from,
-                                   booleans)
-from hypothesis.extra.numpy import (arrays, mutually_broadcastable_shapes as
-                                    mbs, BroadcastableShapes)
+                                   builds, shared, composite, booleans,
+                                   permutations)
+from hypothesis.extra.numpy import (arrays, from_dtype,
+                                    mutually_broadcastable_shapes as mbs,
+                                    BroadcastableShapes)
 
 from ..ndindex import ndindex
 
@@ -23,9 +23,13 @@ from ..ndindex import ndindex
 # hypothesis's slices strategy does not generate slices with negative indices.
 # Similarly, hypothesis.extra.numpy.basic_indices only generates tuples.
 
-# np.prod has overflow and math.prod is Python 3.8+ only
-def prod(seq):
-    return reduce(mul, seq, 1)
+# np.prod has overflow, so use math.prod, falling back to a pure Python
+# version on Python 3.7, which does not have it.
+try:
+    from math import prod
+except ImportError: # pragma: no cover
+    def prod(seq):
+        return reduce(mul, seq, 1)
 
 nonnegative_ints = integers(0, 10)
 negative_ints = integers(-10, -1)
@@ -45,21 +49,52 @@ def tuples(elements, *, min_size=0, max_size=None, unique_by=None, unique=False)
 
 MAX_ARRAY_SIZE = 100000
 SHORT_MAX_ARRAY_SIZE = 1000
-shapes = tuples(integers(0, 10)).filter(
-             # numpy gives errors with empty arrays with large shapes.
-             # See https://github.com/numpy/numpy/issues/15753
-             lambda shape: prod([i for i in shape if i]) < MAX_ARRAY_SIZE)
-
-_short_shapes = tuples(integers(0, 10)).filter(
-             # numpy gives errors with empty arrays with large shapes.
-             # See https://github.com/numpy/numpy/issues/15753
-             lambda shape: prod([i for i in shape if i]) < SHORT_MAX_ARRAY_SIZE)
-
-# Note: We could use something like this:
-
-# mutually_broadcastable_shapes = shared(integers(1, 32).flatmap(lambda i: mbs(num_shapes=i).filter(
-#     lambda broadcastable_shapes: prod([i for i in broadcastable_shapes.result_shape if i]) < MAX_ARRAY_SIZE)))
 
+# Tests that only index into an arange can use views of this instead of
+# allocating a new array for every example, e.g., ARANGE_POOL[:size] or
+# ARANGE_POOL[:prod(shape)].reshape(shape). It is read-only so that a test
+# cannot accidentally modify it for the other tests.
+ARANGE_POOL = arange(MAX_ARRAY_SIZE)
+ARANGE_POOL.setflags(write=False)
+
+# numpy gives errors with empty arrays with large shapes, so the size used to
+# filter shapes ignores the zero dimensions.
+# See https://github.com/numpy/numpy/issues/15753
+def _nonzero_size(shape):
+    size = 1
+    for i in shape:
+        if i:
+            size *= i
+    return size
+
+def _small_shape(shape):
+    return _nonzero_size(shape) < MAX_ARRAY_SIZE
+
+def _short_shape(shape):
+    return _nonzero_size(shape) < SHORT_MAX_ARRAY_SIZE
+
+shapes = tuples(integers(0, 10)).filter(_small_shape)
+
+_short_shapes = tuples(integers(0, 10)).filter(_short_shape)
+
+def _broadcast_compatible_shapes(shapes):
+    # Same as numpy.broadcast_shapes(*shapes), but without the overhead of the
+    # call into NumPy. This assumes the shapes are known to be broadcast
+    # compatible and does not check it. Note that a dimension of 0 broadcasts
+    # with 1, so each size is the first one that isn't 1, not the maximum.
+    result = []
+    for dims in zip_longest(*map(reversed, shapes), fillvalue=1):
+        size = 1
+        for i in dims:
+            if i != 1:
+                size = i
+                break
+        result.append(size)
+    return tuple(reversed(result))
+
+@lru_cache(maxsize=1024)
+def _mbs(num_shapes, base_shape):
+    return mbs(num_shapes=num_shapes, base_shape=base_shape, min_side=0)
 
 @composite
 def _mutually_broadcastable_shapes(draw):
@@ -79,33 +114,39 @@ def _mutually_broadcastable_shapes(draw):
     # way of handling the situation).
     base_shape = draw(short_shapes)
 
-    input_shapes, result_shape = draw(
-        mbs(
-            num_shapes=32,
-            base_shape=base_shape,
-            min_side=0,
-        ))
-
     # The hypothesis mutually_broadcastable_shapes doesn't allow num_shapes to
-    # be a strategy. It's tempting to do something like num_shapes =
-    # draw(integers(1, 32)), but this shrinks poorly. See
-    # https://github.com/HypothesisWorks/hypothesis/issues/3151. So instead of
-    # using a strategy to draw the number of shapes, we just generate 32
-    # shapes and pick a subset of them.
-    final_input_shapes = draw(lists(sampled_from(input_shapes), min_size=0, max_size=32,
-                        unique_by=id,))
+    # be a strategy, so we draw it first and look up the corresponding
+    # strategy. Generating fewer shapes is cheaper than always generating 32.
+    num_shapes = draw(integers(1, 32))
+    input_shapes, result_shape = draw(_mbs(num_shapes, base_shape))
+
+    # Drawing num_shapes alone shrinks poorly. See
+    # https://github.com/HypothesisWorks/hypothesis/issues/3151. So we also
+    # pick a subset of the generated shapes, which can shrink independently.
+    # The subset is the first k elements of a permutation, which avoids the
+    # overhead of drawing a list with unique_by, and shrinks to the first k
+    # shapes in order.
+    k = draw(integers(0, len(input_shapes)))
+    perm = draw(permutations(range(len(input_shapes))))
+    final_input_shapes = [input_shapes[i] for i in perm[:k]]
 
 
     # Note: result_shape is input_shapes broadcasted with base_shape, but
     # base_shape itself is not part of input_shapes. We "really" want our base
     # shape to be (). We are only using it here to trick
     # mutually_broadcastable_shapes into giving more interesting examples.
-    final_result_shape = broadcast_shapes(*final_input_shapes)
+    if all(not shape for shape in final_input_shapes):
+        # Common case, including when final_input_shapes is empty.
+        final_result_shape = ()
+    else:
+        final_result_shape = _broadcast_compatible_shapes(final_input_shapes)
 
     # The broadcast compatible shapes can be bigger than the base shape. This
     # is already somewhat limited by the mutually_broadcastable_shapes
     # defaults, and pretty unlikely, but we filter again here just to be safe.
-    if not prod([i for i in final_result_shape if i]) < SHORT_MAX_ARRAY_SIZE: # pragma: no cover
+    # The result shape is very often (), which never needs filtering, so skip
+    # computing the size in that case.
+    if final_result_shape and not _short_shape(final_result_shape): # pragma: no cover
         note(f"Filtering {result_shape}")
         assume(False)
 
@@ -135,27 +176,85 @@ def skip_axes(draw):
 # uses ndindices, boolean_arrays, or tuples
 short_shapes = shared(_short_shapes)
 
+# Generate either the array itself or its list form. Converting a large array
+# to a list is expensive, and large list indices don't test anything that
+# small ones don't, so only small arrays are converted.
+@composite
+def _array_or_list(draw, array_strategy):
+    x = draw(array_strategy)
+    return x.tolist() if x.size <= 32 and draw(booleans()) else x
+
 _integer_arrays = arrays(intp, short_shapes)
-integer_scalars = arrays(intp, ()).map(lambda x: x[()])
-integer_arrays = one_of(integer_scalars, _integer_arrays.flatmap(lambda x: one_of(just(x), just(x.tolist()))))
+# Draw scalars directly rather than allocating a 0-d array per example only to
+# take the scalar out of it.
+integer_scalars = from_dtype(dtype(intp)).map(intp)
+integer_arrays = one_of(integer_scalars, _array_or_list(_integer_arrays))
 
 @composite
 def subsequences(draw, sequence):
     seq = draw(sequence)
-    start = draw(integers(0, max(0, len(seq)-1)))
-    stop = draw(integers(start, len(seq)))
-    return seq[start:stop]
+    L = len(seq)
+    if L == 0:
+        return seq
+    # Draw a single integer k and decode it into the pair (start, stop), with
+    # 0 <= start < L and start <= stop <= L, ordered by start and then by
+    # stop. There are L*(L + 3)//2 such pairs, and k = 0 shrinks to
+    # seq[0:0].
+    k = draw(integers(0, L*(L + 3)//2 - 1))
+    start = 0
+    while k > L - start:
+        k -= L - start + 1
+        start += 1
+    return seq[start:start + k]
 
 _boolean_arrays = arrays(bool_, one_of(subsequences(short_shapes), short_shapes))
-boolean_scalars = arrays(bool_, ()).map(lambda x: x[()])
-boolean_arrays = one_of(boolean_scalars, _boolean_arrays.flatmap(lambda x: one_of(just(x), just(x.tolist()))))
-
-def _doesnt_raise(idx):
+boolean_scalars = from_dtype(dtype(bool_)).map(bool_)
+boolean_arrays = one_of(boolean_scalars, _array_or_list(_boolean_arrays))
+
+# Hypothesis redraws the same small indices many times while shrinking, so
+# the ndindex objects constructed by the _doesnt_raise filter are cached. Indices may contain
+# unhashable objects (arrays, lists, and slices), so they are first converted
+# to a hashable key from which the index can be reconstructed. The type is
+# included in the key so that, e.g., True and 1 do not share a cache entry.
+def _hashable_key(idx):
+    if isinstance(idx, ndarray):
+        return (ndarray, idx.shape, idx.dtype.str, idx.tobytes())
+    if isinstance(idx, (tuple, list)):
+        return (type(idx), tuple([_hashable_key(i) for i in idx]))
+    if isinstance(idx, slice):
+        return (slice, idx.start, idx.stop, idx.step)
+    return (type(idx), idx)
+
+def _from_hashable_key(key):
+    t = key[0]
+    if t is ndarray:
+        _, shape, dtype_str, data = key
+        return frombuffer(data, dtype=dtype_str).reshape(shape)
+    if t in (tuple, list):
+        return t([_from_hashable_key(i) for i in key[1]])
+    if t is slice:
+        return slice(*key[1:])
+    return key[1]
+
+@lru_cache(maxsize=4096)
+def _cached_ndindex(key):
     try:
-        ndindex(idx)
+        return ndindex(_from_hashable_key(key))
     except (IndexError, ValueError, NotImplementedError):
-        return False
-    return True
+        return None
+
+def cached_ndindex(idx):
+    """
+    Return ndindex(idx), or None if it raises an exception.
+
+    For an index drawn from Tuples or ndindices, this reuses the object that
+    was already constructed by the strategy filter, so tests can pass it as
+    the index argument to check_same() instead of constructing it again.
+    """
+    return _cached_ndindex(_hashable_key(idx))
+
+def _doesnt_raise(idx):
+    return cached_ndindex(idx) is not None
 
 Tuples = tuples(one_of(ellipses(), ints(), slices(), newaxes(),
                        integer_arrays, boolean_arrays)).filter(_doesnt_raise)
@@ -176,14 +275,26 @@ def assert_equal(actual, desired, err_msg='', verbose=True):
     dtypes to be equal.
 
     """
-    numpy.testing.assert_equal(actual, desired, err_msg=err_msg,
-                               verbose=verbose)
     assert actual.shape == desired.shape, err_msg or f"{actual.shape} != {desired.shape}"
     assert actual.dtype == desired.dtype, err_msg or f"{actual.dtype} != {desired.dtype}"
-
-def check_same(a, idx, raw_func=lambda a, idx: a[idx],
-               ndindex_func=lambda a, index: a[index.raw],
-               same_exception=True, assert_equal=assert_equal):
+    # numpy.array_equal is much faster than numpy.testing.assert_equal, so
+    # only fall back to the latter when it fails. This gives a better error
+    # message, and also keeps the numpy.testing.assert_equal behavior of
+    # treating nan as equal to nan.
+    if not numpy.array_equal(actual, desired):
+        numpy.testing.assert_equal(actual, desired, err_msg=err_msg, # pragma: no cover
+                                   verbose=verbose)
+
+# Prefixes of the NumPy warning messages handled by check_same() below.
+_DEP_PREFIXES = ("Using a non-tuple sequence for multidimensional indexing is deprecated",)
+_OOB_PREFIXES = ("Out of bound index found.",)
+
+# Sentinel for the default raw_func and ndindex_func in check_same(). The
+# default indexing is done inline, which avoids a function call per index.
+_DEFAULT_FUNC = object()
+
+def check_same(a, idx, raw_func=_DEFAULT_FUNC, ndindex_func=_DEFAULT_FUNC,
+               same_exception=True, assert_equal=assert_equal, index=None):
     """
     Check that a raw index idx produces the same result on an array a before
     and after being transformed by ndindex.
@@ -204,35 +315,36 @@ def check_same(a, idx, raw_func=lambda a, idx: a[idx],
         def assert_equal(x, y):
             assert x == y
 
+    If index is given, it is used in place of ndindex(idx). This lets tests
+    that check the same index against many arrays construct it only once.
+
     """
     exception = None
     try:
+        a_raw = a[idx] if raw_func is _DEFAULT_FUNC else raw_func(a, idx)
+    except Warning as w:
         # Handle list indices that NumPy treats as tuple indices with a
         # deprecation warning. We want to test against the post-deprecation
         # behavior.
-        e_inner = None
-        try:
+        if w.args[0].startswith(_DEP_PREFIXES):
+            idx = array(idx)
+            index = None
             try:
-                a_raw = raw_func(a, idx)
-            except Warning as w:
-                if ("Using a non-tuple sequence for multidimensional indexing is deprecated" in w.args[0]):
-                    idx = array(idx)
-                    a_raw = raw_func(a, idx)
-                elif "Out of bound index found. This was previously ignored when the indexing result contained no elements. In the future the index error will be raised. This error occurs either due to an empty slice, or if an array has zero elements even before indexing." in w.args[0]:
-                    same_exception = False
-                    raise IndexError
-                else: # pragma: no cover
-                    fail(f"Unexpected warning raised: {w}")
-        except Exception:
-            _, e_inner, _ = sys.exc_info()
-        if e_inner:
-            raise e_inner
+                a_raw = a[idx] if raw_func is _DEFAULT_FUNC else raw_func(a, idx)
+            except Exception as e:
+                exception = e
+        elif w.args[0].startswith(_OOB_PREFIXES):
+            same_exception = False
+            exception = IndexError()
+        else: # pragma: no cover
+            fail(f"Unexpected warning raised: {w}")
     except Exception as e:
         exception = e
 
     try:
-        index = ndindex(idx)
-        a_ndindex = ndindex_func(a, index)
+        if index is None:
+            index = ndindex(idx)
+        a_ndindex = a[index.raw] if ndindex_func is _DEFAULT_FUNC else ndindex_func(a, index)
     except Exception as e:
         if not exception:
             fail(f"Raw form does not raise but ndindex form does ({e!r}): {index})") # pragma: no cover
@@ -255,18 +367,15 @@ def iterslice(start_range=(-10, 10),
     # one_two_args is unnecessary if the args are being passed to slice(),
     # since slice() already canonicalizes missing arguments to None. We do it
     # for Slice to test that behavior.
-    if one_two_args:
-        for start in chain(range(*start_range), [None]):
-            yield (start,)
+    starts = (*range(*start_range), None)
+    stops = (*range(*stop_range), None)
+    steps = (*range(*step_range), None)
 
-        for start in chain(range(*start_range), [None]):
-            for stop in chain(range(*stop_range), [None]):
-                yield (start, stop)
+    if one_two_args:
+        return chain(product(starts), product(starts, stops),
+                     product(starts, stops, steps))
 
-    for start in chain(range(*start_range), [None]):
-        for stop in chain(range(*stop_range), [None]):
-            for step in chain(range(*step_range), [None]):
-                yield (start, stop, step)
+    return product(starts, stops, steps)
 
 
 chunk_shapes = shared(shapes)
@@ -275,4 +384,4 @@ chunk_shapes = shared(shapes)
 def chunk_sizes(draw, shapes=chunk_shapes):
     shape = draw(shapes)
     return draw(tuples(integers(1, 10), min_size=len(shape),
-                       max_size=len(shape)).filter(lambda shape: prod(shape) < MAX_ARRAY_SIZE))
+                       max_size=len(shape)).filter(_small_shape))
@@ -7,7 +7,8 @@ from hypothesis.strategies import integers, one_of
 
 from ..integer import Integer
 from ..slice import Slice
-from .helpers import check_same, ints, prod, shapes, iterslice, assert_equal
+from .helpers import (check_same, ints, prod, shapes, iterslice,
+                      assert_equal, ARANGE_POOL)
 
 def test_integer_args():
     zero = Integer(0)
@@ -31,7 +32,7 @@ def test_integer_exhaustive():
 
 @given(ints(), integers(5, 100))
 def test_integer_hypothesis(i, size):
-    a = arange(size)
+    a = ARANGE_POOL[:size]
     check_same(a, i)
 
 
@@ -9,7 +9,8 @@ from ..slice import Slice
 from ..integer import Integer
 from ..ellipsis import ellipsis
 from ..ndindex import asshape
-from .helpers import check_same, slices, prod, shapes, iterslice, assert_equal
+from .helpers import (check_same, slices, prod, shapes, iterslice,
+                      assert_equal, ARANGE_POOL)
 
 def test_slice_args():
     # Test the behavior when not all three arguments are given
@@ -37,14 +38,24 @@ def test_slice_args():
     assert S.args == (S.start, S.stop, S.step)
 
 def test_slice_exhaustive():
+    # Construct each Slice once rather than once per array size. Invalid
+    # slices are left as None so that check_same() tests the exception.
+    indices = []
+    for start, stop, step in iterslice(one_two_args=False):
+        s = slice(start, stop, step)
+        try:
+            indices.append((s, Slice(s)))
+        except ValueError:
+            indices.append((s, None))
+
     for n in range(100):
         a = arange(n)
-        for start, stop, step in iterslice(one_two_args=False):
-            check_same(a, slice(start, stop, step))
+        for s, index in indices:
+            check_same(a, s, index=index)
 
 @given(slices(), integers(0, 100))
 def test_slice_hypothesis(s, size):
-    a = arange(size)
+    a = ARANGE_POOL[:size]
     check_same(a, s)
 
 def test_slice_len_exhaustive():
@@ -10,7 +10,8 @@ from pytest import raises
 from ..ndindex import ndindex
 from ..tuple import Tuple
 from ..integer import Integer
-from .helpers import check_same, Tuples, prod, short_shapes, iterslice
+from .helpers import (check_same, Tuples, prod, short_shapes, iterslice,
+                      ARANGE_POOL, cached_ndindex)
 
 def test_tuple_constructor():
     # Test things in the Tuple constructor that are not tested by the other
@@ -39,37 +40,35 @@ def test_tuple_exhaustive():
     # explosion.
     a = arange(2*2*2).reshape((2, 2, 2))
     types = {
-        slice: lambda: iterslice((-1, 1), (-1, 1), (-1, 1), one_two_args=False),
+        slice: iterslice((-1, 1), (-1, 1), (-1, 1), one_two_args=False),
         # slice: _iterslice,
-        int: lambda: ((i,) for i in range(-3, 3)),
-        type(...): lambda: ()
+        int: ((i,) for i in range(-3, 3)),
+        type(...): ()
     }
 
+    # Construct the individual indices once up front rather than once for
+    # every combination with the other two.
+    indices = {t: tuple(t(*args) for args in types[t]) for t in types}
+
     for t1, t2, t3 in product(types, repeat=3):
-        for t1_args in types[t1]():
-            for t2_args in types[t2]():
-                for t3_args in types[t3]():
-                    idx1 = t1(*t1_args)
-                    idx2 = t2(*t2_args)
-                    idx3 = t3(*t3_args)
-
-                    idx = (idx1, idx2, idx3)
-                    # Disable the same exception check because there could be
-                    # multiple invalid indices in the tuple, and for instance
-                    # numpy may give an IndexError but we would give a
-                    # TypeError because we check the type first.
-                    check_same(a, idx, same_exception=False)
-                    try:
-                        index = Tuple(*idx)
-                    except (IndexError, ValueError):
-                        pass
-                    else:
-                        assert index.has_ellipsis == (type(...) in (t1, t2, t3))
+        for idx in product(indices[t1], indices[t2], indices[t3]):
+            try:
+                index = Tuple(*idx)
+            except (IndexError, ValueError):
+                index = None
+            else:
+                assert index.has_ellipsis == (type(...) in (t1, t2, t3))
+
+            # Disable the same exception check because there could be
+            # multiple invalid indices in the tuple, and for instance numpy
+            # may give an IndexError but we would give a TypeError because we
+            # check the type first.
+            check_same(a, idx, same_exception=False, index=index)
 
 @given(Tuples, short_shapes)
 def test_tuples_hypothesis(t, shape):
-    a = arange(prod(shape)).reshape(shape)
-    check_same(a, t, same_exception=False)
+    a = ARANGE_POOL[:prod(shape)].reshape(shape)
+    check_same(a, t, same_exception=False, index=cached_ndindex(t))
 
 @given(Tuples, short_shapes)
 def test_ellipsis_index(t, shape):
@@ -79,7 +78,7 @@ def test_ellipsis_index(t, shape):
         return a[ndindex((*index.raw[:index.ellipsis_index], ...,
                           *index.raw[index.ellipsis_index+1:])).raw]
 
-    check_same(a, t, ndindex_func=ndindex_func)
+    check_same(a, t, ndindex_func=ndindex_func, index=cached_ndindex(t))
 
 @example((True, 0, False), 1)
 @example((..., None), ())